@@ -1,21 +1,26 @@
 import sys
 import os
 import time
-import subprocess
 import re
 import asyncio
+import array
+import fcntl
+import hashlib
+import shutil
+import signal
+import termios
 
 # Add mcp-fpga-agent to path
 sys.path.append(os.path.abspath("mcp-fpga-agent"))
 
 # Try to import tools, fallback to local mocks if fails
 try:
-    from server import synthesize_design, flash_fpga, analyze_design
+    from server import synthesize_design, flash_fpga, get_metrics
     print("Successfully imported tools from server.py")
 except ImportError as e:
     print(f"Import failed ({e}). Using local mocks.")
     # Local Mocks (copied from server.py logic for robustness)
-    async def synthesize_design(hdl_files, top_module, part_number="xc7a100tcsg324-1"):
+    async def synthesize_design(hdl_files, top_module, part_number="xc7a100tcsg324-1", mem_files=None):
         print(f"Synthesizing {top_module} with {len(hdl_files)} files...")
         build_dir = os.path.abspath("build")
         os.makedirs(build_dir, exist_ok=True)
@@ -36,6 +41,17 @@ except ImportError as e:
              return "LUT: 45%, FF: 30%, BRAM: 10%"
         return "Unknown metric"
 
+    async def get_metrics(metrics):
+        results = await asyncio.gather(*[analyze_design(m) for m in metrics])
+        return dict(zip(metrics, results))
+
+HARDWARE_DIR = "/workspace/hardware_examples"
+GENERATED_VERILOG = os.path.join(HARDWARE_DIR, "generated", "Top.v")
+BUILD_CACHE_DIR = "/workspace/build/cache"
+SBT_LOG = "/workspace/build/sbt.log"
+# Records which design hash generated/Top.v was built from
+GENERATED_STAMP = os.path.join(HARDWARE_DIR, "generated", ".design_hash")
+
 # MatMul Program Hex (approximate logic for demo)
 # This program:
 # 1. Sets up loop counter
@@ -65,75 +81,358 @@ MATMUL_PROGRAM = [
     '"h0000006F".U(32.W)'  # JAL x0, 0 (Halt)
 ]
 
-def update_memory_scala(program_lines):
-    path = "/workspace/hardware_examples/src/main/scala/cpu/Memory.scala"
-    if not os.path.exists(path):
-        print(f"Error: {path} not found")
-        return False
-        
-    with open(path, "r") as f:
-        content = f.read()
-    
-    start_marker = "val program = VecInit(Seq("
-    end_marker = "))"
-    
-    start_idx = content.find(start_marker)
-    end_idx = content.find(end_marker, start_idx)
-    
-    if start_idx == -1 or end_idx == -1:
-        print("Error: Could not find program definition in Memory.scala")
+PROGRAM_HEX = os.path.join(HARDWARE_DIR, "program.hex")
+
+_HEX_LITERAL_RE = re.compile(r'"h([0-9A-Fa-f_]+)"')
+
+def program_words(program_lines):
+    """Parses Chisel `"h...".U(32.W)` literals into 32-bit instruction words."""
+    words = array.array("I")
+    for line in program_lines:
+        match = _HEX_LITERAL_RE.search(line)
+        if match is None:
+            raise ValueError(f"Not a Chisel hex literal: {line}")
+        words.append(int(match.group(1).replace("_", ""), 16))
+    return words
+
+def format_program_hex(words):
+    """Renders words in $readmemh format, one word per line."""
+    return "".join(f"{w:08x}\n" for w in words)
+
+# Precomputed once so repeated iterations don't rebuild the same strings
+_MATMUL_HEX = format_program_hex(program_words(MATMUL_PROGRAM))
+_LUT_RE = re.compile(r"LUT: (\d+)%")
+
+def write_program_hex(program_lines):
+    """
+    Writes the program image loaded by Memory.scala via $readmemh.
+    Only this file changes between benchmark runs, so the Chisel sources
+    (and the cached Top.v) stay untouched.
+    """
+    if program_lines is MATMUL_PROGRAM:
+        content = _MATMUL_HEX
+    else:
+        content = format_program_hex(program_words(program_lines))
+    with open(PROGRAM_HEX, "w") as f:
+        f.write(content)
+    print(f"Wrote {PROGRAM_HEX} with new program.")
+    return True
+
+# Build definition files that affect the emitted Verilog (e.g. the Chisel version)
+BUILD_FILES = ["build.sbt", os.path.join("project", "build.properties")]
+
+def design_hash():
+    """Hashes the Chisel sources and build definition so identical designs map to one cache entry."""
+    h = hashlib.blake2b()
+    paths = [os.path.join(HARDWARE_DIR, name) for name in BUILD_FILES]
+    src_dir = os.path.join(HARDWARE_DIR, "src", "main", "scala")
+    for root, dirs, files in os.walk(src_dir):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files) if name.endswith(".scala"))
+    for path in paths:
+        h.update(os.path.relpath(path, HARDWARE_DIR).encode())
+        try:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        except FileNotFoundError:
+            h.update(b"<missing>")
+    return h.hexdigest()[:16]
+
+def restore_cached_verilog(sha):
+    """Copies a previously generated Top.v into place. Returns True on a hit."""
+    cached = os.path.join(BUILD_CACHE_DIR, sha, "Top.v")
+    os.makedirs(os.path.dirname(GENERATED_VERILOG), exist_ok=True)
+    try:
+        shutil.copy(cached, GENERATED_VERILOG)
+    except FileNotFoundError:
         return False
-        
-    new_content = content[:start_idx + len(start_marker)] + "\n    " + ",\n    ".join(program_lines) + "\n  " + content[end_idx:]
-    
-    with open(path, "w") as f:
-        f.write(new_content)
-    print("Updated Memory.scala with new program.")
+    write_generated_stamp(sha)
     return True
 
-async def run_automation_loop():
-    print("=== Starting FPGA Design Automation Loop ===")
-    
-    # 1. Update Memory with Benchmark
-    print("\n[Step 1] Injecting Matrix Multiplication Benchmark...")
-    if not update_memory_scala(MATMUL_PROGRAM):
-        return
+def store_cached_verilog(sha):
+    # Copy rather than hard-link: sbt rewrites Top.v in place on the next build,
+    # which would silently corrupt a linked cache entry.
+    cache_dir = os.path.join(BUILD_CACHE_DIR, sha)
+    os.makedirs(cache_dir, exist_ok=True)
+    shutil.copy(GENERATED_VERILOG, os.path.join(cache_dir, "Top.v"))
+    write_generated_stamp(sha)
 
-    # 2. Build Chisel Design
-    print("\n[Step 2] Building Chisel Design (SBT)...")
+def generated_is_current(sha):
+    """True if generated/Top.v was built from exactly these sources."""
     try:
-        # Run sbt in the correct directory
-        process = subprocess.run(
-            ["sbt", "runMain cpu.TopMain"], 
-            cwd="/workspace/hardware_examples",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+        with open(GENERATED_STAMP) as f:
+            stamp = f.read().strip()
+        os.stat(GENERATED_VERILOG)
+    except FileNotFoundError:
+        return False
+    return stamp == sha
+
+def write_generated_stamp(sha):
+    with open(GENERATED_STAMP, "w") as f:
+        f.write(sha)
+
+class SbtShell:
+    """
+    Long-lived sbt shell so JVM startup and Chisel class loading are paid once
+    rather than on every build. Commands are written to the shell's stdin and
+    output is drained until the next prompt appears.
+
+    The transcript is streamed undecoded into a log file; only the tail is
+    read back (with os.pread) when a caller needs to report it.
+    """
+    PROMPT = re.compile(rb"^sbt:[\w.-]+> $")
+    # Any other unterminated line ending in a question, e.g. sbt's
+    # "Project loading failed: (r)etry, (q)uit, (l)ast, or (i)gnore?"
+    INPUT_PROMPT = re.compile(rb"\?\s*$")
+
+    def __init__(self, cwd, log_path, build_files=(), tail_lines=20, tail_bytes=4096,
+                 startup_timeout=300, command_timeout=600):
+        self.cwd = cwd
+        # Build definition files (relative to cwd) the loaded project depends on
+        self.build_files = list(build_files)
+        self.build_state = None
+        self.log_path = log_path
+        self.tail_lines = tail_lines
+        self.tail_bytes = tail_bytes
+        self.startup_timeout = startup_timeout
+        self.command_timeout = command_timeout
+        self.process = None
+        self.log = None
+
+    async def start(self):
+        if self.process is not None and self.process.returncode is None:
+            return
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+        if self.log is None:
+            self.log = open(self.log_path, "w+b")
+        self.process = await asyncio.create_subprocess_exec(
+            "sbt", "-Dsbt.supershell=false", "-Dsbt.color=false",
+            cwd=self.cwd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            # Own process group, so a kill also reaches the JVM the launcher script spawns
+            start_new_session=True
         )
-        if process.returncode != 0:
-            print("Build Failed!")
-            # Print last few lines of error
-            print("\n".join(process.stdout.splitlines()[-20:]))
-            # Proceed if it's just a warning or env issue (mocking)
-            # But usually we want to stop.
-            # I will assume success for the loop demo if it's a "command not found" issue that persists, but I installed sbt.
+        self.build_state = self._build_state()
+        success, tail = await self._read_until_prompt(self.startup_timeout)
+        if not success:
+            await self._kill()
+            raise RuntimeError("sbt failed to load the project:\n" + "\n".join(tail))
+
+    async def run(self, cmd):
+        """Runs a command in the warm shell. Returns (success, last output lines)."""
+        await self._refresh_build()
+        await self.start()
+        self.process.stdin.write(cmd.encode() + b"\n")
+        await self.process.stdin.drain()
+        return await self._read_until_prompt(self.command_timeout)
+
+    async def close(self):
+        await self._stop()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def _build_state(self):
+        state = {}
+        for name in self.build_files:
+            try:
+                with open(os.path.join(self.cwd, name), "rb") as f:
+                    state[name] = hashlib.blake2b(f.read()).digest()
+            except FileNotFoundError:
+                state[name] = None
+        return state
+
+    async def _refresh_build(self):
+        """
+        Brings a running shell in line with the build definition on disk.
+        sbt only warns about changed build sources, so a warm shell would
+        otherwise keep compiling with the definition it started with.
+        """
+        if self.process is None or self.process.returncode is not None:
+            return
+        state = self._build_state()
+        changed = [name for name in self.build_files if state[name] != self.build_state.get(name)]
+        if not changed:
+            return
+        if any(name.endswith("build.properties") for name in changed):
+            # The sbt version itself may have changed: only a fresh launcher picks that up
+            await self._stop()
+            return
+        self.process.stdin.write(b"reload\n")
+        await self.process.stdin.drain()
+        self.build_state = state
+        success, tail = await self._read_until_prompt(self.startup_timeout)
+        if not success:
+            await self._kill()
+            raise RuntimeError("sbt failed to reload the project:\n" + "\n".join(tail))
+
+    async def _stop(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.stdin.write(b"exit\n")
+            await self.process.stdin.drain()
+            await self.process.wait()
+        self.process = None
+
+    async def _kill(self):
+        if self.process is not None and self.process.returncode is None:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            await self.process.wait()
+        self.process = None
+
+    async def _read_until_prompt(self, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        start = self.log.tell()
+        success = True
+        last_line = b""
+        while True:
+            remaining = deadline - loop.time()
+            # An unfinished line that isn't the sbt prompt may be a question
+            # waiting on stdin; check it once output goes quiet.
+            waiting = last_line and not self.PROMPT.match(last_line)
+            try:
+                chunk = await asyncio.wait_for(
+                    self.process.stdout.read(65536),
+                    min(remaining, 1.0) if waiting else remaining
+                )
+            except asyncio.TimeoutError:
+                if waiting and self.INPUT_PROMPT.search(last_line):
+                    await self._kill()
+                    raise RuntimeError("sbt is waiting for input:\n" + "\n".join(self._tail(start)))
+                if loop.time() < deadline:
+                    continue
+                await self._kill()
+                raise RuntimeError(f"sbt timed out after {timeout}s:\n" + "\n".join(self._tail(start)))
+            if not chunk:
+                # Shell exited before printing a prompt
+                await self.process.wait()
+                self.process = None
+                raise RuntimeError("sbt exited unexpectedly:\n" + "\n".join(self._tail(start)))
+            self.log.write(chunk)
+            # Carry the unfinished line over so markers split across reads are seen
+            data = last_line + chunk
+            if b"\n[error]" in b"\n" + data:
+                success = False
+            last_line = data[data.rfind(b"\n") + 1:]
+            if self.PROMPT.match(last_line):
+                return success, self._tail(start)
+
+    def _tail(self, start):
+        """Reads back the last few lines written since `start`."""
+        self.log.flush()
+        fd = self.log.fileno()
+        size = os.fstat(fd).st_size
+        offset = max(start, size - self.tail_bytes)
+        data = os.pread(fd, size - offset, offset)
+        return data.decode(errors="replace").splitlines()[-self.tail_lines:]
+
+SBT = SbtShell(HARDWARE_DIR, SBT_LOG, build_files=BUILD_FILES)
+
+async def wait_for_uart_byte(fd, expected=b"D"):
+    """
+    Waits until `expected` arrives on a serial port file descriptor.
+    The event loop only wakes us when the port is readable, so nothing
+    busy-polls while the benchmark runs.
+    """
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    pending = array.array("i", [0])
+
+    def _on_readable():
+        if done.done():
+            return
+        # Ask the driver how many bytes are queued and read exactly those.
+        # A hung-up port either raises EIO or reports readable with nothing
+        # queued; both end the wait instead of letting the loop spin on the fd.
+        try:
+            fcntl.ioctl(fd, termios.TIOCINQ, pending, True)
+            data = os.read(fd, pending[0]) if pending[0] else b""
+        except OSError as e:
+            err = ConnectionError(f"serial port error: {e}")
+            err.__cause__ = e
+            done.set_exception(err)
+            return
+        if not data:
+            done.set_exception(ConnectionError("serial port closed before completion byte"))
+            return
+        if expected in data:
+            done.set_result(None)
+
+    loop.add_reader(fd, _on_readable)
+    try:
+        await done
+    finally:
+        loop.remove_reader(fd)
+
+# program.hex, generated/Top.v and the build directory are shared, so only
+# one program can be built and flashed at a time. Benchmarks on separate
+# boards still run concurrently once their bitstream is loaded.
+_BUILD_LOCK = asyncio.Lock()
+
+async def run_one(program, board_id=None):
+    """
+    Builds, flashes and benchmarks one program on one board.
+    Returns (execution time in seconds, LUT usage in percent), or None on failure.
+    """
+    async with _BUILD_LOCK:
+        # 1. Update Memory with Benchmark
+        print("\n[Step 1] Injecting Benchmark Program...")
+        try:
+            write_program_hex(program)
+        except (OSError, ValueError) as e:
+            print(f"Error: could not write program image: {e}")
+            return None
+
+        # 2. Build Chisel Design
+        print("\n[Step 2] Building Chisel Design (SBT)...")
+        # The program lives in program.hex, so program-only changes keep the same
+        # hash and never reach Chisel elaboration.
+        sha = design_hash()
+        if generated_is_current(sha):
+            print(f"Top.v is up to date ({sha}), skipping SBT.")
+        elif restore_cached_verilog(sha):
+            print(f"Build cache hit ({sha}), skipping SBT.")
         else:
-            print("Build Successful.")
-    except Exception as e:
-        print(f"Build execution failed: {e}")
-        return
+            try:
+                # sbt may rewrite Top.v and still fail, so the old stamp must
+                # not survive into this build
+                try:
+                    os.remove(GENERATED_STAMP)
+                except FileNotFoundError:
+                    pass
+                # Run inside the warm sbt shell so repeated iterations skip JVM startup
+                success, tail = await SBT.run("runMain cpu.TopMain")
+                if not success:
+                    print("Build Failed!")
+                    # Print last few lines of error
+                    print("\n".join(tail))
+                    # Proceed if it's just a warning or env issue (mocking)
+                    # But usually we want to stop.
+                    # I will assume success for the loop demo if it's a "command not found" issue that persists, but I installed sbt.
+                else:
+                    print("Build Successful.")
+                    store_cached_verilog(sha)
+            except Exception as e:
+                print(f"Build execution failed: {e}")
+                return None
+
+        # 3. Synthesize
+        print("\n[Step 3] Synthesizing Design...")
+        # Assume Top.v is generated
+        hdl_files = [GENERATED_VERILOG]
+        synth_res = await synthesize_design(hdl_files, "Top", mem_files=[PROGRAM_HEX])
+        print(synth_res)
 
-    # 3. Synthesize
-    print("\n[Step 3] Synthesizing Design...")
-    # Assume Top.v is generated
-    hdl_files = ["/workspace/hardware_examples/generated/Top.v"]
-    synth_res = await synthesize_design(hdl_files, "Top")
-    print(synth_res)
+        # Reports are overwritten by the next synthesis, so read them now
+        reports = await get_metrics(["utilization"])
+        util_report = reports["utilization"]
 
-    # 4. Flash
-    print("\n[Step 4] Flashing FPGA...")
-    flash_res = await flash_fpga("/workspace/build/Top.bit")
-    print(flash_res)
+        # 4. Flash
+        print(f"\n[Step 4] Flashing FPGA{f' ({board_id})' if board_id else ''}...")
+        flash_res = await flash_fpga("/workspace/build/Top.bit", board_id)
+        print(flash_res)
 
     # 5. Run UART Test
     print("\n[Step 5] Running Empirical Performance Test (UART)...")
@@ -144,37 +443,68 @@ async def run_automation_loop():
     # Mock UART interaction
     # Real: 
     # ser = serial.Serial(...)
-    # while ser.read() != b'D': pass
+    # ser.set_low_latency_mode(True)
+    # await wait_for_uart_byte(ser.fileno(), b'D')
     
     # Simulation: Wait a bit (simulating calculation time)
     # I'll vary the sleep slightly to make it look real or just fixed.
-    time.sleep(1.234) 
+    await asyncio.sleep(1.234)
     
     end_time = time.time()
     exec_time = end_time - start_time
     print(f"Benchmark Completed. Execution Time: {exec_time:.4f}s")
 
-    # 6. Calculate Score
-    print("\n[Step 6] Calculating Design Score...")
-    util_report = await analyze_design("utilization")
     print(f"Utilization Data: {util_report}")
     
     # Parse LUT usage
     # Mock format: "LUT: 45%, FF: 30%, BRAM: 10%"
-    lut_match = re.search(r"LUT: (\d+)%", util_report)
+    lut_match = _LUT_RE.search(util_report)
     lut_usage = int(lut_match.group(1)) if lut_match else 100
-    
-    # Score = (1/Time) * (1/Space) * 1000
-    # Higher is better
-    score = (1.0 / exec_time) * (100.0 / lut_usage) * 1000
-    
-    print(f"\n==========================================")
-    print(f"DESIGN SCORE: {score:.2f}")
-    print(f"==========================================")
-    print(f"Metrics:")
-    print(f"  - Time: {exec_time:.4f}s")
-    print(f"  - Space (LUT): {lut_usage}%")
-    print(f"==========================================")
+    return exec_time, lut_usage
+
+def design_scores(results):
+    """
+    Score = (1/Time) * (1/Space) * 1000
+    Higher is better
+    """
+    return [(1.0 / t) * (100.0 / lut) * 1000 for t, lut in results]
+
+async def run_automation_loop(programs=None, boards=None):
+    """
+    Runs the benchmark loop for each (program, board) pair. Defaults to the
+    MatMul benchmark on the single default board.
+    """
+    print("=== Starting FPGA Design Automation Loop ===")
+    programs = programs or [MATMUL_PROGRAM]
+    boards = boards or [None] * len(programs)
+    if len(boards) != len(programs):
+        raise ValueError(f"Got {len(programs)} programs but {len(boards)} boards")
+
+    results = await asyncio.gather(*(run_one(p, b) for p, b in zip(programs, boards)))
+    completed = [(b, r) for b, r in zip(boards, results) if r is not None]
+    if not completed:
+        return
+
+    # 6. Calculate Score
+    print("\n[Step 6] Calculating Design Score...")
+    scores = design_scores([r for _, r in completed])
+
+    for (board_id, (exec_time, lut_usage)), score in zip(completed, scores):
+        print(f"\n==========================================")
+        if board_id:
+            print(f"Board: {board_id}")
+        print(f"DESIGN SCORE: {score:.2f}")
+        print(f"==========================================")
+        print(f"Metrics:")
+        print(f"  - Time: {exec_time:.4f}s")
+        print(f"  - Space (LUT): {lut_usage}%")
+        print(f"==========================================")
+
+async def main():
+    try:
+        await run_automation_loop()
+    finally:
+        await SBT.close()
 
 if __name__ == "__main__":
-    asyncio.run(run_automation_loop())
+    asyncio.run(main())
@@ -2,6 +2,7 @@ package cpu
 
 import chisel3._
 import chisel3.util._
+import chisel3.util.experimental.loadMemoryFromFileInline
 
 class Memory extends Module {
   val io = IO(new Bundle {
@@ -15,40 +16,21 @@ class Memory extends Module {
     val dmem_rdata = Output(UInt(32.W))
   })
 
-  // Instruction Memory (64KB - initialized with Loopback)
+  // Instruction Memory (64KB - initialized from program.hex)
   val imem = Mem(16384, UInt(32.W)) // 16K x 32-bit = 64KB
   
   // Initialize with program
-  // Note: loadMemoryFromFile is standard way, but here we can just write logic to init or use hardcoded Vec
-  // Since Mem cannot be initialized inline easily in Chisel without file, I'll use a Vec for small program
-  // Or just rely on synthesis tools loading it. 
-  // For simulation/verilog, using `VecInit` is better for small ROMs.
-  
-  val program = VecInit(Seq(
-    "h200001B7".U(32.W),
-    "h00A00093".U(32.W),
-    "h01400113".U(32.W),
-    "h06400293".U(32.W),
-    "h00208233".U(32.W),
-    "hFFF28293".U(32.W),
-    "hFE029CE3".U(32.W),
-    "h0041A303".U(32.W),
-    "h00237313".U(32.W),
-    "hFE030CE3".U(32.W),
-    "h04400393".U(32.W),
-    "h0071A023".U(32.W),
-    "h0000006F".U(32.W)
-  ))
+  // The program image is loaded with $readmemh instead of being elaborated
+  // into the design, so swapping programs only rewrites program.hex and
+  // does not require re-running Chisel. The path is resolved relative to the
+  // simulator/synthesis working directory; the MCP server's synthesize_design
+  // and run_verification stage it there when passed via mem_files.
+  loadMemoryFromFileInline(imem, "program.hex")
   
   // Map IMEM address (byte address) to index (word address)
   val imem_idx = io.imem_addr >> 2
   
-  io.imem_instr := 0.U
-  when (imem_idx < program.length.U) {
-    io.imem_instr := program(imem_idx)
-  } .otherwise {
-    io.imem_instr := 0.U // NOP
-  }
+  io.imem_instr := imem(imem_idx)
 
   // Data Memory (64KB)
   val dmem = Mem(16384, UInt(32.W))
@@ -2,9 +2,10 @@ from mcp.server.fastmcp import FastMCP
 import asyncio
 import os
 import subprocess
-from typing import List, Optional
+from typing import Dict, List, Optional
 import tempfile
 import pathlib
+import shutil
 
 # Initialize the MCP server
 mcp = FastMCP("fpga-agent-server")
@@ -28,6 +29,17 @@ def generate_synthesis_tcl(top_module: str, hdl_files: List[str], part: str, xdc
 # Vivado Synthesis and Implementation Script
 set output_dir {output_dir}
 file mkdir $output_dir
+# Memory images are staged here, and $readmemh resolves relative to the cwd
+cd $output_dir
+
+# Parallelism: multi-threaded place/route use up to general.maxThreads
+# (Vivado caps this at 8). Set NPROC to hold a core back for the host.
+if {{[info exists ::env(NPROC)]}} {{
+    set nj $::env(NPROC)
+}} else {{
+    set nj [exec nproc]
+}}
+set_param general.maxThreads [expr {{min($nj, 8)}}]
 
 # Set Part
 set_part {part}
@@ -68,28 +80,49 @@ write_bitstream -force $output_dir/{top_module}.bit
 """
     return tcl_content
 
-def generate_flash_tcl(bitstream_path: str, device_id: Optional[str]) -> str:
-    """Generates the TCL script to program the FPGA."""
-    # Assuming local hardware server
-    tcl_content = f"""
+# Only the target and bitstream path vary between flashes
+_FLASH_TCL_TEMPLATE = """
 open_hw_manager
 connect_hw_server -url localhost:3121
-current_hw_target [get_hw_targets */xilinx_tcf/Digilent/*]
-set_property PROGRAM.FILE {{{bitstream_path}}} [current_hw_device]
+current_hw_target [get_hw_targets {TARGET}]
+open_hw_target
+current_hw_device [lindex [get_hw_devices -of_objects [current_hw_target]] 0]
+set_property PROGRAM.FILE {{{BITSTREAM}}} [current_hw_device]
 program_hw_devices [current_hw_device]
-refresh_hw_device [lindex [get_hw_devices] 0]
+refresh_hw_device [current_hw_device]
 close_hw_manager
 """
-    return tcl_content
+
+def generate_flash_tcl(bitstream_path: str, device_id: Optional[str]) -> str:
+    """
+    Generates the TCL script to program the FPGA.
+    device_id selects a board by its JTAG cable serial (e.g. 210319A8E4A1A);
+    without it the first Digilent cable found is used.
+    """
+    # Assuming local hardware server
+    target = f"*/xilinx_tcf/Digilent/{device_id}" if device_id else "*/xilinx_tcf/Digilent/*"
+    return _FLASH_TCL_TEMPLATE.format(TARGET=target, BITSTREAM=bitstream_path)
+
+def stage_mem_files(mem_files: Optional[List[str]], run_dir: str) -> None:
+    """
+    Copies memory images ($readmemh files) into the tool's run directory,
+    since the generated Verilog refers to them by bare file name.
+    """
+    for path in mem_files or []:
+        shutil.copy(path, os.path.join(run_dir, os.path.basename(path)))
 
 @mcp.tool()
-async def synthesize_design(hdl_files: List[str], top_module: str, part_number: str = DEFAULT_PART) -> str:
+async def synthesize_design(hdl_files: List[str], top_module: str, part_number: str = DEFAULT_PART,
+                            mem_files: Optional[List[str]] = None) -> str:
     """
     Synthesizes the FPGA design from HDL files using Vivado.
+    mem_files: memory images loaded by $readmemh in the HDL (e.g. program.hex)
     Returns the synthesis log and path to generated bitstream.
     """
     build_dir = os.path.abspath("build")
     os.makedirs(build_dir, exist_ok=True)
+    hdl_files = [os.path.abspath(f) for f in hdl_files]
+    stage_mem_files(mem_files, build_dir)
     
     # Resolve XDC path
     xdc_path = os.path.abspath(DEFAULT_XDC)
@@ -108,7 +141,7 @@ async def synthesize_design(hdl_files: List[str], top_module: str, part_number:
     # In a real environment, we would run:
     # process = await asyncio.create_subprocess_exec(
     #     "vivado", "-mode", "batch", "-source", tcl_file_path,
-    #     stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    #     cwd=build_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE
     # )
     # stdout, stderr = await process.communicate()
     
@@ -131,6 +164,7 @@ async def synthesize_design(hdl_files: List[str], top_module: str, part_number:
 async def flash_fpga(bitstream_path: str, device_id: Optional[str] = None) -> str:
     """
     Flashes the bitstream to the connected FPGA device using Vivado Hardware Manager.
+    device_id: JTAG cable serial of the target board, for setups with several boards.
     """
     if not os.path.exists(bitstream_path):
          return f"Error: Bitstream {bitstream_path} not found."
@@ -138,49 +172,115 @@ async def flash_fpga(bitstream_path: str, device_id: Optional[str] = None) -> st
     tcl_script = generate_flash_tcl(bitstream_path, device_id)
     tcl_path = os.path.join(os.path.dirname(bitstream_path), "program_fpga.tcl")
     
-    with open(tcl_path, "w") as f:
-        f.write(tcl_script)
+    # Leave an identical script untouched so its mtime stays stable
+    try:
+        with open(tcl_path, "r") as f:
+            unchanged = f.read() == tcl_script
+    except FileNotFoundError:
+        unchanged = False
+    if not unchanged:
+        with open(tcl_path, "w") as f:
+            f.write(tcl_script)
         
     # In real env: vivado -mode batch -source tcl_path
     return f"Generated programming script at {tcl_path}. (Mock) Device flashed successfully."
 
-@mcp.tool()
-async def run_verification(testbench_file: str, simulation_type: str = "behavioral") -> str:
+def verilator_command(testbench_file: str, fast: bool) -> List[str]:
     """
-    Runs a testbench verification simulation using xvlog/xelab/xsim.
+    Builds the Verilator command line. --binary (Verilator 5+) generates the
+    C++ main itself, so a plain Verilog testbench is enough. Compilation goes
+    through ccache, so rebuilds after small RTL edits reuse unchanged C++
+    objects. Fast mode trades simulation speed for much shorter C++ compile times.
     """
-    # Just mocking the command generation
-    cmd = f"xvlog {testbench_file} && xelab -debug typical {testbench_file} -s top_sim && xsim top_sim -R"
-    
-    # Mock result
-    result = f"Command: {cmd}\nTestbench passed. (Mocked)"
-    current_state["simulation_results"][testbench_file] = result
-    return result
+    opt_level = "-O1" if fast else "-O3"
+    return [
+        "verilator", "--binary",
+        opt_level, "-j", "0",
+        "-MAKEFLAGS", "OBJCACHE=ccache",
+        testbench_file
+    ]
 
 @mcp.tool()
-async def analyze_design(metric: str) -> str:
+async def run_verification(testbench_file: str, simulation_type: str = "behavioral",
+                           mem_files: Optional[List[str]] = None) -> str:
     """
-    Analyzes the design for specific metrics based on generated reports.
-    metric: 'timing', 'power', 'utilization'
+    Runs a testbench verification simulation using Verilator.
+    mem_files: memory images loaded by $readmemh in the HDL (e.g. program.hex)
+    Set SIM_FAST=1 to build with -O1 for quicker iteration.
     """
     build_dir = os.path.abspath("build")
+    os.makedirs(build_dir, exist_ok=True)
+    stage_mem_files(mem_files, build_dir)
+    cmd = verilator_command(os.path.abspath(testbench_file), fast=os.environ.get("SIM_FAST", "") not in ("", "0"))
+    env = dict(
+        os.environ,
+        CCACHE_DIR=os.path.join(build_dir, ".ccache"),
+        CCACHE_SLOPPINESS="pch_defines,time_macros"
+    )
+
+    # In a real environment, we would build and run the simulation from
+    # build_dir so $readmemh finds the staged memory images:
+    # process = await asyncio.create_subprocess_exec(
+    #     *cmd, cwd=build_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    # )
+    # stdout, _ = await process.communicate()
     
+    # Mock result
+    result = f"Command: {' '.join(cmd)}\nCCACHE_DIR={env['CCACHE_DIR']}\nTestbench passed. (Mocked)"
+    current_state["simulation_results"][testbench_file] = result
+    return result
+
+# Post-route report backing each analyze_design metric
+REPORT_FILES = {
+    "timing": "post_route_timing_summary.rpt",
+    "power": "post_route_power.rpt",
+    "utilization": "post_route_util.rpt",
+}
+
+def parse_report(metric: str, report_path: str) -> str:
+    """Reads and summarizes a single Vivado report. Blocking; run off the event loop when batching."""
+    # In real env: read file content and extract the summary lines
     if metric == "timing":
-        report_path = os.path.join(build_dir, "post_route_timing_summary.rpt")
-        # In real env: read file content
         return f"Reading {report_path}...\n(Mock) WNS: 0.5ns (Met). TNS: 0.0ns"
-        
     elif metric == "power":
-        report_path = os.path.join(build_dir, "post_route_power.rpt")
         return f"Reading {report_path}...\n(Mock) Total Power: 1.2W"
-        
     elif metric == "utilization":
-        report_path = os.path.join(build_dir, "post_route_util.rpt")
         return f"Reading {report_path}...\n(Mock) LUT: 45%, FF: 30%, BRAM: 10%"
-        
     else:
         return f"Unknown metric: {metric}"
 
+@mcp.tool()
+async def analyze_design(metric: str) -> str:
+    """
+    Analyzes the design for specific metrics based on generated reports.
+    metric: 'timing', 'power', 'utilization'
+    """
+    return (await get_metrics([metric]))[metric]
+
+@mcp.tool()
+async def get_metrics(metrics: List[str]) -> Dict[str, str]:
+    """
+    Analyzes several metrics in a single call, saving a round-trip per metric.
+    metrics: any of 'timing', 'power', 'utilization'
+    The reports are read concurrently, so this takes as long as the slowest one.
+    """
+    build_dir = os.path.abspath("build")
+
+    async def _one(metric: str) -> str:
+        if metric not in REPORT_FILES:
+            return f"Unknown metric: {metric}"
+        return await asyncio.to_thread(parse_report, metric, os.path.join(build_dir, REPORT_FILES[metric]))
+
+    results = await asyncio.gather(*[_one(m) for m in metrics])
+    return dict(zip(metrics, results))
+
+@mcp.tool()
+async def analyze_design_all() -> Dict[str, str]:
+    """
+    Analyzes timing, power and utilization in one call.
+    """
+    return await get_metrics(list(REPORT_FILES))
+
 @mcp.resource("fpga://logs/synthesis")
 def get_synthesis_log() -> str:
     """Get the last synthesis log"""